@@ -0,0 +1,174 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Lower value = served first when a slot frees up
+PRIORITY_HISTORY = 0
+PRIORITY_CHAT = 1
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request cannot be admitted; carries the HTTP status and Retry-After"""
+
+    def __init__(self, status, reason, retry_after):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Pending:
+    """Result slot shared by duplicate submissions of the same request"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class AdmissionController:
+    """Per-user in-flight limits plus a bounded, prioritised global queue.
+
+    At most `max_concurrent` generations run at once. Up to `max_queue` more
+    may wait for a slot, ordered by priority then arrival. Anything beyond
+    that is shed immediately with a 503, and a user exceeding `max_per_user`
+    in-flight generations gets a 429.
+
+    History reads are cheap Mongo queries, so they get their own
+    `max_reads` slots instead of waiting behind generations, and they do not
+    count toward the per-user limit.
+    """
+
+    def __init__(self, max_concurrent=4, max_queue=32, max_per_user=2,
+                 queue_timeout=30, retry_after=5, max_reads=16, generation_timeout=120):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_per_user = max_per_user
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.max_reads = max_reads
+        # Longest a duplicate waits for its leader: queueing plus one generation
+        self.duplicate_timeout = queue_timeout + generation_timeout
+
+        self._cond = threading.Condition()
+        self._running = 0
+        self._reads = 0
+        self._waiting = []  # heap of (priority, seq)
+        self._seq = itertools.count()
+        self._per_user = {}
+        self._pending = {}
+
+    def _release_user(self, user_id):
+        count = self._per_user.get(user_id, 0) - 1
+        if count > 0:
+            self._per_user[user_id] = count
+        else:
+            self._per_user.pop(user_id, None)
+
+    @contextmanager
+    def _admit_read(self):
+        with self._cond:
+            deadline = time.monotonic() + self.queue_timeout
+            while self._reads >= self.max_reads:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.warning("No read slot available, shedding history request")
+                    raise AdmissionRejected(503, 'Server busy, please retry later', self.retry_after)
+                self._cond.wait(remaining)
+            self._reads += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._reads -= 1
+                self._cond.notify_all()
+
+    @contextmanager
+    def admit(self, user_id, priority=PRIORITY_CHAT):
+        """Hold a slot for the duration of the block or raise AdmissionRejected"""
+        if priority == PRIORITY_HISTORY:
+            with self._admit_read():
+                yield
+            return
+
+        with self._cond:
+            if self._per_user.get(user_id, 0) >= self.max_per_user:
+                logger.warning(f"User {user_id} exceeded {self.max_per_user} in-flight requests")
+                raise AdmissionRejected(429, 'Too many concurrent requests', self.retry_after)
+
+            if self._running >= self.max_concurrent and len(self._waiting) >= self.max_queue:
+                logger.warning("Admission queue full, shedding request")
+                raise AdmissionRejected(503, 'Server busy, please retry later', self.retry_after)
+
+            self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+            ticket = (priority, next(self._seq))
+            heapq.heappush(self._waiting, ticket)
+            deadline = time.monotonic() + self.queue_timeout
+
+            # Wait until a slot is free and this ticket is at the head of the queue
+            while self._running >= self.max_concurrent or self._waiting[0] != ticket:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._waiting.remove(ticket)
+                    heapq.heapify(self._waiting)
+                    self._release_user(user_id)
+                    self._cond.notify_all()
+                    logger.warning(f"Request for user {user_id} timed out in admission queue")
+                    raise AdmissionRejected(503, 'Server busy, please retry later', self.retry_after)
+                self._cond.wait(remaining)
+
+            heapq.heappop(self._waiting)
+            self._running += 1
+            # The next ticket may also fit if more than one slot is free
+            self._cond.notify_all()
+
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._running -= 1
+                self._release_user(user_id)
+                self._cond.notify_all()
+
+    def deduplicate(self, key, func):
+        """Run func once per key; concurrent callers with the same key share its result"""
+        with self._cond:
+            pending = self._pending.get(key)
+            leader = pending is None
+            if leader:
+                pending = _Pending()
+                self._pending[key] = pending
+
+        if not leader:
+            logger.info("Duplicate submission detected, waiting for in-flight result")
+            if not pending.done.wait(self.duplicate_timeout):
+                logger.warning("Timed out waiting for duplicate submission's result")
+                raise AdmissionRejected(503, 'Server busy, please retry later', self.retry_after)
+            if pending.error:
+                raise pending.error
+            return pending.result
+
+        try:
+            pending.result = func()
+            return pending.result
+        except Exception as e:
+            pending.error = e
+            raise
+        finally:
+            with self._cond:
+                self._pending.pop(key, None)
+            pending.done.set()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "running": self._running,
+                "reads": self._reads,
+                "queued": len(self._waiting),
+                "users_in_flight": len(self._per_user),
+            }
@@ -0,0 +1,211 @@
+"""Offline retrieval quality vs. latency evaluation.
+
+Runs the retrieval stage of ChatAssistant._get_context against a seeded local
+dataset under several configurations and reports recall@k, MRR, prompt token
+counts and per-stage latency side by side.
+
+Run from the server directory (importing the bot package would start the
+whole assistant):
+
+    python bot/evaluate_retrieval.py --dataset seed.json --labels labels.jsonl \\
+        --config baseline \\
+        --config small-chunks:chunk_size=500,overlap=50 \\
+        --config wide:k=20,query=label
+
+Dataset (JSON): {"students": [...], "internships": [...]} where every record
+has an "id"; students carry either "cv_text" or a "resume" PDF path and
+internships a "companyId". Labels (JSON lines):
+{"query": "...", "role": "student"|"company", "user_id": "...", "expected": ["<id>", ...]}
+"""
+import argparse
+import json
+import logging
+import time
+import tiktoken
+from langchain_huggingface import HuggingFaceEmbeddings
+from utils import retrieval
+from utils import context as context_builder
+from utils.pdf_parser import extract_text_from_pdf
+from prompts import PromptBuilder
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+STAGES = ["corpus", "index", "search", "prompt"]
+
+
+def parse_config(spec):
+    """Parse `name[:key=value,...]` into a retrieval configuration"""
+    name, _, options = spec.partition(":")
+    config = {
+        "name": name,
+        "chunk_size": retrieval.DEFAULT_CHUNK_SIZE,
+        "overlap": retrieval.DEFAULT_OVERLAP,
+        "k": None,  # role default
+        "model": DEFAULT_MODEL,
+        "space": None,
+        "query": "fixed"  # "fixed" = production query, "label" = the labelled query
+    }
+    for option in filter(None, options.split(",")):
+        key, _, value = option.partition("=")
+        if key not in config or key == "name":
+            raise ValueError(f"Unknown option '{key}' in config '{name}'")
+        config[key] = int(value) if key in ("chunk_size", "overlap", "k") else value
+    if config["query"] not in ("fixed", "label"):
+        raise ValueError("query must be 'fixed' or 'label'")
+    return config
+
+
+class Dataset:
+    def __init__(self, path):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        # Ids double as _id so the corpus metadata carries them like in production;
+        # cv_summary keys off resumeUrl, so inline CV text counts as an upload
+        self.students = [dict(s, _id=s["id"], resumeUrl=s.get("resume") or ("inline" if s.get("cv_text") else "")) for s in data.get("students", [])]
+        self.internships = [dict(i, _id=i["id"]) for i in data.get("internships", [])]
+        self.students_by_id = {s["id"]: s for s in self.students}
+
+        # CVs are extracted once, up front, so no configuration's corpus
+        # latency includes PDF parsing; the cost is reported on its own
+        started = time.perf_counter()
+        self._cv_texts = {}
+        for student in self.students:
+            if student.get("cv_text"):
+                text = student["cv_text"]
+            elif student.get("resume"):
+                text = extract_text_from_pdf(student["resume"])
+            else:
+                text = ""
+            self._cv_texts[student["id"]] = text
+        self.cv_extraction_ms = (time.perf_counter() - started) * 1000
+
+    def cv_text(self, student):
+        return self._cv_texts[student["id"]]
+
+
+class Evaluator:
+    def __init__(self, dataset, labels):
+        self.dataset = dataset
+        self.labels = labels
+        self.encoding = tiktoken.get_encoding("cl100k_base")
+        self._models = {}
+
+    def _embeddings(self, model):
+        if model not in self._models:
+            # Model load time is excluded from the per-query latencies
+            self._models[model] = HuggingFaceEmbeddings(model_name=model)
+        return self._models[model]
+
+    def _tokens(self, text):
+        return len(self.encoding.encode(text))
+
+    def _corpus(self, label, config):
+        """Build the searched texts and the prompt context for one labelled query"""
+        dataset = self.dataset
+        if label["role"] == "student":
+            student = dataset.students_by_id[label["user_id"]]
+            cv_text = dataset.cv_text(student)
+            texts, metadatas = retrieval.build_student_corpus(
+                student, cv_text, dataset.internships, config["chunk_size"], config["overlap"]
+            )
+            context = context_builder.student_context(student, cv_text, dataset.internships)
+            return texts, metadatas, context, retrieval.STUDENT_QUERY, retrieval.DEFAULT_STUDENT_K
+
+        internships = [i for i in dataset.internships if i.get("companyId") == label["user_id"]]
+        cv_texts = [dataset.cv_text(s) for s in dataset.students]
+        texts, metadatas = retrieval.build_company_corpus(
+            dataset.students, cv_texts, internships, config["chunk_size"], config["overlap"]
+        )
+        context = context_builder.company_context(dataset.students, cv_texts, internships)
+        return texts, metadatas, context, retrieval.COMPANY_QUERY, retrieval.DEFAULT_COMPANY_K
+
+    def run(self, config):
+        embeddings = self._embeddings(config["model"])
+        prompt_builder = PromptBuilder()
+        timings = {stage: [] for stage in STAGES}
+        recalls, reciprocal_ranks, prompt_tokens, context_tokens = [], [], [], []
+
+        for label in self.labels:
+            started = time.perf_counter()
+            texts, metadatas, context, fixed_query, default_k = self._corpus(label, config)
+            corpus_done = time.perf_counter()
+            vectorstore = retrieval.build_index(embeddings, texts, metadatas, config["space"])
+            index_done = time.perf_counter()
+            query = label["query"] if config["query"] == "label" else fixed_query
+            k = config["k"] or default_k
+            docs = retrieval.search(vectorstore, query, k)
+            search_done = time.perf_counter()
+            system_prompt = prompt_builder.build(label["role"], context)
+            prompt_done = time.perf_counter()
+
+            for stage, (start, end) in zip(STAGES, [(started, corpus_done), (corpus_done, index_done),
+                                                    (index_done, search_done), (search_done, prompt_done)]):
+                timings[stage].append((end - start) * 1000)
+
+            # Several chunks can belong to the same entity; rank entities by first hit
+            ranked = []
+            for doc in docs:
+                entity = doc.metadata.get("internship_id") or doc.metadata.get("student_id")
+                if entity and entity not in ranked:
+                    ranked.append(entity)
+            expected = set(label["expected"])
+            hits = [rank for rank, entity in enumerate(ranked, start=1) if entity in expected]
+            recalls.append(len(hits) / len(expected) if expected else 0.0)
+            reciprocal_ranks.append(1 / hits[0] if hits else 0.0)
+            prompt_tokens.append(self._tokens(system_prompt) + self._tokens(label["query"]))
+            context_tokens.append(sum(self._tokens(doc.page_content) for doc in docs))
+
+        count = len(self.labels) or 1
+        return {
+            "config": config,
+            "recall@k": sum(recalls) / count,
+            "mrr": sum(reciprocal_ranks) / count,
+            "prompt_tokens": sum(prompt_tokens) / count,
+            "retrieved_tokens": sum(context_tokens) / count,
+            "latency_ms": {stage: sum(values) / count for stage, values in timings.items()}
+        }
+
+
+def format_table(results):
+    rows = [("config", lambda r: r["config"]["name"]),
+            ("chunk_size/overlap", lambda r: f"{r['config']['chunk_size']}/{r['config']['overlap']}"),
+            ("k", lambda r: str(r["config"]["k"] or "default")),
+            ("query", lambda r: r["config"]["query"]),
+            ("recall@k", lambda r: f"{r['recall@k']:.3f}"),
+            ("MRR", lambda r: f"{r['mrr']:.3f}"),
+            ("prompt tokens", lambda r: f"{r['prompt_tokens']:.0f}"),
+            ("retrieved tokens", lambda r: f"{r['retrieved_tokens']:.0f}")]
+    rows += [(f"{stage} ms", lambda r, stage=stage: f"{r['latency_ms'][stage]:.1f}") for stage in STAGES]
+    rows.append(("total ms", lambda r: f"{sum(r['latency_ms'].values()):.1f}"))
+
+    cells = [[label] + [render(r) for r in results] for label, render in rows]
+    widths = [max(len(row[col]) for row in cells) for col in range(len(cells[0]))]
+    return "\n".join("  ".join(cell.ljust(width) for cell, width in zip(row, widths)) for row in cells)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare retrieval configurations on a labelled local dataset")
+    parser.add_argument("--dataset", required=True, help="seeded dataset JSON")
+    parser.add_argument("--labels", required=True, help="labelled queries, one JSON object per line")
+    parser.add_argument("--config", action="append", default=[], help="name[:key=value,...]; may be repeated")
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    dataset = Dataset(args.dataset)
+    print(f"CV extraction (once, excluded from corpus latency): {dataset.cv_extraction_ms:.1f} ms")
+    with open(args.labels, encoding="utf-8") as f:
+        labels = [json.loads(line) for line in f if line.strip()]
+
+    evaluator = Evaluator(dataset, labels)
+    results = [evaluator.run(parse_config(spec)) for spec in args.config or ["baseline"]]
+    print(format_table(results))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+import atexit
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import uuid
+from datetime import datetime
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+
+def _truncate_to_millis(value):
+    # Mongo stores datetimes with millisecond precision; keep buffered copies comparable
+    return value.replace(microsecond=value.microsecond // 1000 * 1000)
+
+
+def _message_key(message):
+    return (message['role'], message['content'], _truncate_to_millis(message['timestamp']))
+
+
+def merge_messages(stored, buffered):
+    """Combine messages read from Mongo with buffered ones, dropping those already flushed"""
+    seen = {_message_key(m) for m in stored}
+    merged = list(stored) + [m for m in buffered if _message_key(m) not in seen]
+    merged.sort(key=lambda m: m['timestamp'])
+    return merged
+
+
+class ChatHistoryBuffer:
+    """Write-behind buffer for `chathistory` pushes.
+
+    Messages are acknowledged as soon as they are buffered and written with a
+    single `bulk_write` once `max_batch` entries are pending or every
+    `flush_interval` seconds. If `spill_dir` is set every entry is also
+    appended (and fsynced) to a per-process log which is replayed on the next
+    start, so acknowledged messages survive a crash.
+
+    Every message carries a `turnId` and is written with `$addToSet`, so
+    retrying a batch that was partly or fully applied (a failed bulk write,
+    or a log replayed after a crash between the write and removing the log)
+    never stores a turn twice.
+
+    Readers merge `pending()` with what Mongo returns, but the buffer lives in
+    one process: with several workers, a request served by a worker other than
+    the one that buffered a turn does not see that turn until it is flushed,
+    i.e. for up to `flush_interval` seconds. Read-your-writes only holds within
+    a worker; keep `flush_interval` short (or run a single worker) where that
+    matters.
+    """
+
+    def __init__(self, db, max_batch=100, flush_interval=1.0, spill_dir=None):
+        self.db = db
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.spill_dir = spill_dir
+
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._pending = []   # (user_id, [messages]) waiting to be written
+        self._inflight = []  # batch currently being written
+        self._spill = None
+
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+            self._replay()
+
+        self._thread = threading.Thread(target=self._run, name='chat-history-flush', daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def _open_spill(self):
+        # PIDs repeat across restarts, so never reuse (and lock) a dead worker's log
+        path = os.path.join(self.spill_dir, f"chathistory-{os.getpid()}-{uuid.uuid4().hex}.log")
+        handle = open(path, 'x', encoding='utf-8')
+        # Held for the file's lifetime so other workers never replay a live log
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        return handle
+
+    def _write_spill(self, user_id, messages):
+        record = {
+            "userId": user_id,
+            "messages": [dict(m, timestamp=m['timestamp'].isoformat()) for m in messages]
+        }
+        self._spill.write(json.dumps(record) + "\n")
+        self._spill.flush()
+        os.fsync(self._spill.fileno())
+
+    def _replay(self):
+        """Re-buffer entries from logs left behind by processes that are no longer running"""
+        # Claim orphaned logs before this process has a log of its own, so
+        # every file found here belongs to another (possibly live) process
+        orphans = []
+        for path in sorted(glob.glob(os.path.join(self.spill_dir, "chathistory-*.log"))):
+            try:
+                handle = open(path, 'r', encoding='utf-8')
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                handle.close()
+                continue
+            orphans.append((path, handle))
+
+        self._spill = self._open_spill()
+        for path, handle in orphans:
+            replayed = 0
+            for line in handle:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"Skipping torn record in {path}")
+                    continue
+                messages = [dict(m, timestamp=datetime.fromisoformat(m['timestamp'])) for m in record['messages']]
+                # Rewritten into the live log, so the orphan can go once it is read
+                self.append(record['userId'], messages)
+                replayed += 1
+            os.unlink(path)
+            handle.close()
+            logger.info(f"Replayed {replayed} buffered chat entries from {path}")
+
+    def append(self, user_id, messages):
+        """Buffer messages for a user's history; returns once they are durable if spilling"""
+        # Key order must stay stable across retries for $addToSet to match
+        messages = [
+            dict(m, timestamp=_truncate_to_millis(m['timestamp']), turnId=m.get('turnId') or uuid.uuid4().hex)
+            for m in messages
+        ]
+        with self._cond:
+            if self._spill:
+                self._write_spill(user_id, messages)
+            self._pending.append((user_id, messages))
+            if len(self._pending) >= self.max_batch:
+                self._cond.notify()
+
+    def pending(self, user_id):
+        """Messages for a user that may not be visible in Mongo yet, oldest first"""
+        with self._cond:
+            return [m for uid, messages in self._inflight + self._pending if uid == user_id for m in messages]
+
+    def flush(self):
+        """Write everything buffered so far with one bulk_write"""
+        with self._flush_lock:
+            with self._cond:
+                if not self._pending:
+                    return
+                spilled = self._spill
+                if spilled:
+                    try:
+                        self._spill = self._open_spill()
+                    except OSError as e:
+                        # Keep appending to the current log and try again next round
+                        logger.error(f"Error rotating chat history log: {str(e)}", exc_info=True)
+                        return
+                self._inflight, self._pending = self._pending, []
+
+            failed = []
+            batch = self._inflight
+            try:
+                grouped = {}
+                for user_id, messages in self._inflight:
+                    grouped.setdefault(user_id, []).extend(messages)
+                user_ids, operations = [], []
+                for user_id, messages in grouped.items():
+                    try:
+                        object_id = ObjectId(user_id)
+                    except (InvalidId, TypeError):
+                        # Can never be stored; retrying would wedge every later batch
+                        logger.error(f"Dropping {len(messages)} chat messages for invalid user id {user_id!r}")
+                        batch = [entry for entry in batch if entry[0] != user_id]
+                        continue
+                    user_ids.append(user_id)
+                    operations.append(UpdateOne(
+                        {"userId": object_id},
+                        # $addToSet keeps $push's append order and skips turns already stored
+                        {"$addToSet": {"messages": {"$each": messages}}},
+                        upsert=True
+                    ))
+                if operations:
+                    self.db.chathistory.bulk_write(operations, ordered=False)
+                logger.info(f"Flushed {len(batch)} chat entries for {len(operations)} users")
+            except BulkWriteError as e:
+                if e.details.get('writeConcernErrors'):
+                    # Durability of the applied writes is unknown; retry the whole batch
+                    failed = batch
+                else:
+                    # Unordered: every operation not listed in writeErrors was applied
+                    failed_users = {user_ids[error['index']] for error in e.details.get('writeErrors', [])}
+                    failed = [entry for entry in batch if entry[0] in failed_users]
+                logger.error(f"Error flushing chat history: {str(e)}")
+            except Exception as e:
+                # Outcome unknown; retrying everything is safe because the write is idempotent
+                failed = batch
+                logger.error(f"Error flushing chat history: {str(e)}", exc_info=True)
+
+            rewritten = True
+            with self._cond:
+                # Re-queue first so failed entries stay buffered even if the log rewrite fails
+                self._pending = failed + self._pending
+                self._inflight = []
+                if failed and self._spill:
+                    try:
+                        # Carry failed entries into the live log before dropping the old one
+                        for user_id, messages in failed:
+                            self._write_spill(user_id, messages)
+                    except OSError as e:
+                        rewritten = False
+                        logger.error(f"Error rewriting chat history log, keeping {spilled.name}: {str(e)}", exc_info=True)
+            if spilled:
+                # Unlink while still holding the lock so no other worker replays it
+                if rewritten:
+                    os.unlink(spilled.name)
+                spilled.close()
+
+    def _run(self):
+        while True:
+            try:
+                with self._cond:
+                    self._cond.wait_for(lambda: len(self._pending) >= self.max_batch, timeout=self.flush_interval)
+                self.flush()
+            except Exception as e:
+                # Never let the flush thread die; entries stay buffered for the next round
+                logger.error(f"Error in chat history flush loop: {str(e)}", exc_info=True)
@@ -0,0 +1,354 @@
+import logging
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import numpy as np
+from bson.objectid import ObjectId
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# MongoDB error code for an existing index with different options
+INDEX_OPTIONS_CONFLICT = 85
+
+# Weight of the semantic similarity vs. the technology overlap in the final score
+SIMILARITY_WEIGHT = 0.8
+TECHNOLOGY_WEIGHT = 0.2
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9][a-z0-9+#.]*")
+
+
+def tokenize(text):
+    """Lowercase word tokens that keep names like c++, c# and node.js intact"""
+    return [token.rstrip('.') for token in TOKEN_PATTERN.findall(text.lower())]
+
+
+def token_ngrams(tokens, max_length):
+    return {
+        tuple(tokens[start:start + length])
+        for length in range(1, max_length + 1)
+        for start in range(len(tokens) - length + 1)
+    }
+
+
+class RankingJobs:
+    """Background ranking of every student against a company's internships.
+
+    Student vectors are cached in the `studentembeddings` collection and only
+    recomputed when the student document changes, so a run is mostly a Mongo
+    read plus one matrix product per batch. Job state lives in `rankjobs` and
+    ranked results in `rankresults`, so any worker process can serve the
+    status and result pages. When an EmbeddingSnapshot is given, vectors are
+    read from the shared memory map and Mongo only supplies what it lacks.
+
+    Jobs run in-process. A heartbeat thread refreshes every job this process
+    owns, whether still queued in the executor or mid-batch, every third of
+    `stale_after`; a job whose owner died stops heartbeating, so any queued or
+    running job not updated for `stale_after` seconds is marked failed. Jobs
+    and results expire after `result_ttl` seconds.
+    """
+
+    def __init__(self, assistant, max_workers=2, batch_size=256, snapshot=None,
+                 stale_after=900, result_ttl=7 * 24 * 3600):
+        self.assistant = assistant
+        self.snapshot = snapshot
+        self.db = assistant.db
+        self.batch_size = batch_size
+        self.stale_after = stale_after
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='rank-job')
+        self._owned = set()  # ids of jobs queued or running in this process
+        self._owned_lock = threading.Lock()
+        self.db.rankresults.create_index([("jobId", 1), ("internshipId", 1), ("rank", 1)])
+        self._ensure_ttl_index(self.db.rankjobs, result_ttl)
+        self._ensure_ttl_index(self.db.rankresults, result_ttl)
+        self._fail_stale_jobs()
+
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat, name='rank-job-heartbeat', daemon=True)
+        self._heartbeat_thread.start()
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(self.stale_after / 3)
+            with self._owned_lock:
+                owned = list(self._owned)
+            if not owned:
+                continue
+            try:
+                self.db.rankjobs.update_many(
+                    {"_id": {"$in": owned}, "status": {"$in": ["queued", "running"]}},
+                    {"$set": {"updatedAt": datetime.now()}}
+                )
+            except Exception as e:
+                # A missed beat is fine; stale_after allows for a few
+                logger.error(f"Error refreshing ranking job heartbeats: {str(e)}", exc_info=True)
+
+    def _ensure_ttl_index(self, collection, ttl):
+        """Create the createdAt TTL index, updating its expiry in place if it changed"""
+        try:
+            collection.create_index("createdAt", expireAfterSeconds=ttl)
+            return
+        except OperationFailure as e:
+            if e.code != INDEX_OPTIONS_CONFLICT:
+                logger.error(f"Error creating TTL index on {collection.name}: {str(e)}", exc_info=True)
+                return
+        try:
+            self.db.command("collMod", collection.name, index={"keyPattern": {"createdAt": 1}, "expireAfterSeconds": ttl})
+            logger.info(f"Updated TTL of {collection.name} to {ttl} seconds")
+        except OperationFailure as e:
+            # Keep serving with the old expiry rather than failing the import
+            logger.error(f"Error updating TTL index on {collection.name}: {str(e)}", exc_info=True)
+
+    def _fail_stale_jobs(self, job_id=None):
+        """Mark queued/running jobs that stopped heartbeating (e.g. after a restart) as failed"""
+        query = {
+            "status": {"$in": ["queued", "running"]},
+            "updatedAt": {"$lt": datetime.now() - timedelta(seconds=self.stale_after)}
+        }
+        if job_id is not None:
+            query["_id"] = job_id
+        stale_ids = [job["_id"] for job in self.db.rankjobs.find(query, {"_id": 1})]
+        if not stale_ids:
+            return
+        self.db.rankjobs.update_many(
+            {"_id": {"$in": stale_ids}, "status": {"$in": ["queued", "running"]}},
+            {"$set": {"status": "failed", "error": "Job was interrupted, please resubmit", "updatedAt": datetime.now()}}
+        )
+        self.db.rankresults.delete_many({"jobId": {"$in": stale_ids}})
+        logger.warning(f"Marked {len(stale_ids)} stale ranking jobs as failed")
+
+    def submit(self, company_id, internship_ids=None):
+        """Create a job for the company's internships and queue it; returns the job id"""
+        query = {"companyId": ObjectId(company_id)}
+        if internship_ids:
+            query["_id"] = {"$in": [ObjectId(i) for i in internship_ids]}
+        internships = list(self.db.internships.find(query, {"title": 1, "description": 1, "technologies": 1, "type": 1}))
+        if not internships:
+            raise ValueError("No matching internships for this company")
+        if internship_ids and len(internships) != len(set(internship_ids)):
+            raise ValueError("Some internships do not exist or belong to another company")
+
+        now = datetime.now()
+        job_id = self.db.rankjobs.insert_one({
+            "companyId": ObjectId(company_id),
+            "internshipIds": [i["_id"] for i in internships],
+            "status": "queued",
+            "progress": {"processed": 0, "total": 0},
+            "createdAt": now,
+            "updatedAt": now
+        }).inserted_id
+
+        with self._owned_lock:
+            self._owned.add(job_id)
+        self.executor.submit(self._run, job_id, internships)
+        logger.info(f"Queued ranking job {job_id} for {len(internships)} internships")
+        return str(job_id)
+
+    def get(self, job_id, company_id, internship_id=None, page=1, per_page=50):
+        """Return job status with one page of results, or None if not found for this company"""
+        query = {"_id": ObjectId(job_id), "companyId": ObjectId(company_id)}
+        job = self.db.rankjobs.find_one(query)
+        if not job:
+            return None
+        if job["status"] in ("queued", "running"):
+            self._fail_stale_jobs(job["_id"])
+            job = self.db.rankjobs.find_one(query)
+
+        result_query = {"jobId": job["_id"]}
+        if internship_id:
+            result_query["internshipId"] = ObjectId(internship_id)
+        total = self.db.rankresults.count_documents(result_query)
+        results = self.db.rankresults.find(result_query, {"_id": 0, "jobId": 0}) \
+            .sort([("internshipId", 1), ("rank", 1)]) \
+            .skip((page - 1) * per_page) \
+            .limit(per_page)
+
+        return {
+            "id": str(job["_id"]),
+            "status": job["status"],
+            "progress": job["progress"],
+            "error": job.get("error"),
+            "internshipIds": [str(i) for i in job["internshipIds"]],
+            "createdAt": job["createdAt"].isoformat(),
+            "updatedAt": job["updatedAt"].isoformat(),
+            "results": {
+                "page": page,
+                "per_page": per_page,
+                "total": total,
+                "items": [
+                    dict(item, internshipId=str(item["internshipId"]), studentId=str(item["studentId"]))
+                    for item in results
+                ]
+            }
+        }
+
+    def _update_job(self, job_id, status=None, **fields):
+        """Update a job this worker is running; False if it was failed as stale meanwhile"""
+        fields["updatedAt"] = datetime.now()
+        if status:
+            fields["status"] = status
+        result = self.db.rankjobs.update_one({"_id": job_id, "status": "running"}, {"$set": fields})
+        return result.matched_count > 0
+
+    def _student_text(self, student, cv_text):
+        return f"""
+        Student: {student.get('name', '')}
+        University: {student.get('university', '')}
+        Degree: {student.get('degree', '')}
+        Year: {student.get('year', '')}
+        CV: {cv_text}
+        """
+
+    def _student_vectors(self, students):
+        """Return (vectors, CV tokens) for a batch, embedding only students whose cache is stale"""
+        ids = [s["_id"] for s in students]
+        cached = {}
+        if self.snapshot:
+            # Vectors come from the shared mmap; only the CV text is needed from Mongo
+            for s in students:
+                vector = self.snapshot.lookup(s["_id"], s.get("updatedAt"))
+                if vector is not None:
+                    cached[s["_id"]] = {"updatedAt": s.get("updatedAt"), "vector": vector}
+            if cached:
+                for c in self.db.studentembeddings.find({"_id": {"$in": list(cached)}}, {"cvText": 1}):
+                    if "cvText" in c:
+                        cached[c["_id"]]["cvText"] = c["cvText"]
+                cached = {i: c for i, c in cached.items() if "cvText" in c}
+        missing = [i for i in ids if i not in cached]
+        if missing:
+            cached.update({c["_id"]: c for c in self.db.studentembeddings.find({"_id": {"$in": missing}})})
+
+        stale = [s for s in students
+                 if s["_id"] not in cached
+                 or cached[s["_id"]].get("updatedAt") != s.get("updatedAt")
+                 or "cvText" not in cached[s["_id"]]]
+        if stale:
+            cv_texts = [
+                self.assistant._get_cv_text(s['resumeUrl'])[:2000] if s.get('resumeUrl') else ""
+                for s in stale
+            ]
+            vectors = self.assistant.embeddings.embed_documents(
+                [self._student_text(s, cv_text) for s, cv_text in zip(stale, cv_texts)]
+            )
+            for student, cv_text, vector in zip(stale, cv_texts, vectors):
+                entry = {"_id": student["_id"], "updatedAt": student.get("updatedAt"), "cvText": cv_text, "vector": vector}
+                self.db.studentembeddings.replace_one({"_id": student["_id"]}, entry, upsert=True)
+                cached[student["_id"]] = entry
+            logger.info(f"Embedded {len(stale)} new or updated students")
+
+        vectors = np.array([cached[i]["vector"] for i in ids], dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
+        # Only the CV is matched against technologies; names and universities would add noise
+        return vectors, [tokenize(cached[i]["cvText"]) for i in ids]
+
+    def _run(self, job_id, internships):
+        try:
+            if self.snapshot:
+                self.snapshot.refresh()
+            total = self.db.users.count_documents({"role": "student"})
+            claimed = self.db.rankjobs.update_one(
+                {"_id": job_id, "status": "queued"},
+                {"$set": {"status": "running", "progress": {"processed": 0, "total": total}, "updatedAt": datetime.now()}}
+            )
+            if not claimed.matched_count:
+                logger.warning(f"Ranking job {job_id} is no longer queued, skipping")
+                return
+
+            internship_texts = [
+                f"{i.get('title', '')}\n{i.get('description', '')}\n{', '.join(i.get('technologies', []))}"
+                for i in internships
+            ]
+            internship_vectors = np.array(self.assistant.embeddings.embed_documents(internship_texts), dtype=np.float32)
+            internship_vectors /= np.linalg.norm(internship_vectors, axis=1, keepdims=True) + 1e-12
+            technologies = [
+                [tuple(tokens) for tokens in (tokenize(t) for t in i.get('technologies', []) if t) if tokens]
+                for i in internships
+            ]
+
+            student_rows = []
+            score_batches = []
+            processed = 0
+            cursor = self.db.users.find(
+                {"role": "student"},
+                {"name": 1, "email": 1, "university": 1, "degree": 1, "year": 1, "resumeUrl": 1, "updatedAt": 1}
+            ).batch_size(self.batch_size)
+
+            batch = []
+            for student in cursor:
+                batch.append(student)
+                if len(batch) >= self.batch_size:
+                    score_batches.append(self._score_batch(batch, internship_vectors, technologies))
+                    student_rows.extend(batch)
+                    processed += len(batch)
+                    batch = []
+                    self._update_job(job_id, progress={"processed": processed, "total": total})
+            if batch:
+                score_batches.append(self._score_batch(batch, internship_vectors, technologies))
+                student_rows.extend(batch)
+                processed += len(batch)
+
+            scores = np.vstack(score_batches) if score_batches else np.zeros((0, len(internships)))
+            self._store_results(job_id, internships, student_rows, scores)
+            if not self._update_job(job_id, status="completed", progress={"processed": processed, "total": processed}):
+                self.db.rankresults.delete_many({"jobId": job_id})
+                logger.warning(f"Ranking job {job_id} was marked failed while running, discarding results")
+                return
+            logger.info(f"Ranking job {job_id} completed for {processed} students")
+        except Exception as e:
+            logger.error(f"Ranking job {job_id} failed: {str(e)}", exc_info=True)
+            self.db.rankresults.delete_many({"jobId": job_id})
+            self.db.rankjobs.update_one(
+                {"_id": job_id, "status": {"$in": ["queued", "running"]}},
+                {"$set": {"status": "failed", "error": str(e), "updatedAt": datetime.now()}}
+            )
+        finally:
+            with self._owned_lock:
+                self._owned.discard(job_id)
+
+    def _score_batch(self, students, internship_vectors, technologies):
+        """Score a batch of students against every internship; returns (students x internships)"""
+        vectors, cv_tokens = self._student_vectors(students)
+        similarity = vectors @ internship_vectors.T
+
+        # Multi-word technologies ("machine learning") match as whole token sequences
+        max_length = max((len(t) for techs in technologies for t in techs), default=1)
+        cv_ngrams = [token_ngrams(tokens, max_length) for tokens in cv_tokens]
+
+        overlap = np.zeros_like(similarity)
+        for col, techs in enumerate(technologies):
+            if not techs:
+                continue
+            for row, ngrams in enumerate(cv_ngrams):
+                overlap[row, col] = sum(1 for t in techs if t in ngrams) / len(techs)
+
+        return SIMILARITY_WEIGHT * similarity + TECHNOLOGY_WEIGHT * overlap
+
+    def _store_results(self, job_id, internships, students, scores):
+        # Never leave results of an earlier, partial attempt next to these
+        self.db.rankresults.delete_many({"jobId": job_id})
+        now = datetime.now()
+        for col, internship in enumerate(internships):
+            order = np.argsort(-scores[:, col], kind='stable')
+            documents = []
+            for rank, row in enumerate(order, start=1):
+                student = students[row]
+                profile = self.assistant._filter_sensitive_data({
+                    "name": student.get('name', ''),
+                    "email": student.get('email', ''),
+                    "university": student.get('university', ''),
+                    "degree": student.get('degree', ''),
+                    "year": student.get('year', '')
+                })
+                documents.append({
+                    "jobId": job_id,
+                    "internshipId": internship["_id"],
+                    "internshipTitle": internship.get('title', ''),
+                    "rank": rank,
+                    "score": round(float(scores[row, col]), 4),
+                    "studentId": student["_id"],
+                    "student": profile,
+                    "createdAt": now
+                })
+            for start in range(0, len(documents), self.batch_size):
+                self.db.rankresults.insert_many(documents[start:start + self.batch_size], ordered=False)
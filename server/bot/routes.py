@@ -1,9 +1,15 @@
 from flask import request, jsonify
 from . import bot
 from .assistant import ChatAssistant
+from .admission import AdmissionController, AdmissionRejected, PRIORITY_CHAT, PRIORITY_HISTORY
+from .jobs import RankingJobs
+from .history_buffer import merge_messages
+from .snapshot import EmbeddingSnapshot
 import os, sys, jwt
+import hashlib
 import logging
 from bson.objectid import ObjectId
+from bson.errors import InvalidId
 from datetime import datetime
 
 # Configure logging
@@ -14,6 +20,26 @@ sys.path.append("..")
 
 chat_assistant = ChatAssistant(os.getenv('OPEN_ROUTE_API_KEY'))
 
+admission = AdmissionController(
+    max_concurrent=int(os.getenv('BOT_MAX_CONCURRENT', 4)),
+    max_queue=int(os.getenv('BOT_MAX_QUEUE', 32)),
+    max_per_user=int(os.getenv('BOT_MAX_PER_USER', 2)),
+    queue_timeout=float(os.getenv('BOT_QUEUE_TIMEOUT', 30)),
+    retry_after=int(os.getenv('BOT_RETRY_AFTER', 5)),
+    max_reads=int(os.getenv('BOT_MAX_READS', 16)),
+    generation_timeout=float(os.getenv('BOT_GENERATION_TIMEOUT', 120))
+)
+
+snapshot_dir = os.getenv('BOT_EMBEDDING_SNAPSHOT_DIR')
+ranking_jobs = RankingJobs(
+    chat_assistant,
+    max_workers=int(os.getenv('BOT_RANK_WORKERS', 2)),
+    batch_size=int(os.getenv('BOT_RANK_BATCH_SIZE', 256)),
+    snapshot=EmbeddingSnapshot(snapshot_dir) if snapshot_dir else None,
+    stale_after=int(os.getenv('BOT_RANK_STALE_AFTER', 900)),
+    result_ttl=int(os.getenv('BOT_RANK_RESULT_TTL', 7 * 24 * 3600))
+)
+
 def get_user_from_token(token):
     try:
         # Remove 'Bearer ' from token
@@ -25,6 +51,9 @@ def get_user_from_token(token):
         logger.error(f"Error decoding token: {str(e)}", exc_info=True)
         return None, None
 
+def rejected_response(e):
+    return jsonify({'error': e.reason}), e.status, {'Retry-After': str(e.retry_after)}
+
 @bot.route('/chat/history', methods=['GET'])
 def get_chat_history():
     try:
@@ -36,27 +65,55 @@ def get_chat_history():
         if not user_id or not user_role:
             return jsonify({'error': 'Invalid token'}), 401
 
-        # Get history with proper sorting
-        chat_history = chat_assistant.db.chathistory.aggregate([
-            {"$match": {"userId": ObjectId(user_id)}},
-            {"$unwind": "$messages"},
-            {"$sort": {"messages.timestamp": 1}},  # Sort chronologically
-            {"$group": {
-                "_id": "$_id",
-                "messages": {"$push": {
-                    "role": "$messages.role",
-                    "content": "$messages.content"
+        with admission.admit(user_id, PRIORITY_HISTORY):
+            # Snapshot buffered turns first: a flush finishing after the read
+            # below would otherwise drop them from both sources
+            # (only this worker's turns; see ChatHistoryBuffer)
+            buffered_messages = chat_assistant.history_buffer.pending(user_id)
+            
+            # Get history with proper sorting
+            chat_history = chat_assistant.db.chathistory.aggregate([
+                {"$match": {"userId": ObjectId(user_id)}},
+                {"$unwind": "$messages"},
+                {"$sort": {"messages.timestamp": 1}},  # Sort chronologically
+                {"$group": {
+                    "_id": "$_id",
+                    "messages": {"$push": {
+                        "role": "$messages.role",
+                        "content": "$messages.content",
+                        "timestamp": "$messages.timestamp"
+                    }}
                 }}
-            }}
-        ])
-        
-        # Handle case where no history exists
-        history = next(chat_history, None)
-        return jsonify({'history': history.get('messages', []) if history else []})
+            ])
+            
+            # Handle case where no history exists
+            history = next(chat_history, None)
+            stored_messages = history.get('messages', []) if history else []
+            messages = merge_messages(stored_messages, buffered_messages)
+        return jsonify({'history': [
+            {"role": m['role'], "content": m['content']} for m in messages
+        ]})
+    except AdmissionRejected as e:
+        return rejected_response(e)
     except Exception as e:
         logger.error(f"Error fetching chat history: {str(e)}", exc_info=True)
         return jsonify({'history': []}), 500
 
+def generate_and_save(message, user_role, user_id):
+    """Generate a reply inside an admission slot and persist both turns"""
+    with admission.admit(user_id, PRIORITY_CHAT):
+        response = chat_assistant.get_response(message, user_role, user_id)
+        if not response or response.isspace():
+            return response
+
+        # Queue messages; the history buffer writes them behind the response
+        now = datetime.now()
+        chat_assistant.history_buffer.append(user_id, [
+            {"role": "user", "content": message, "timestamp": now},
+            {"role": "assistant", "content": response, "timestamp": now}
+        ])
+    return response
+
 @bot.route('/chat', methods=['POST'])
 def chat():
     try:
@@ -79,30 +136,67 @@ def chat():
             return jsonify({'error': 'Empty message'}), 400
 
         logger.info(f"Processing message: {message[:50]}...")
-        response = chat_assistant.get_response(message, user_role, user_id)
+        dedup_key = (user_id, hashlib.sha256(message.encode('utf-8')).hexdigest())
+        response = admission.deduplicate(
+            dedup_key, lambda: generate_and_save(message, user_role, user_id)
+        )
         
         if not response or response.isspace():
             return jsonify({'error': 'Empty response from assistant'}), 500
 
-        # Save messages
-        now = datetime.now()
-        chat_assistant.db.chathistory.update_one(
-            {"userId": ObjectId(user_id)},
-            {
-                "$push": {
-                    "messages": {
-                        "$each": [
-                            {"role": "user", "content": message, "timestamp": now},
-                            {"role": "assistant", "content": response, "timestamp": now}
-                        ]
-                    }
-                }
-            },
-            upsert=True
-        )
-
         logger.info("Successfully generated response")
         return jsonify({'response': response})
+    except AdmissionRejected as e:
+        return rejected_response(e)
     except Exception as e:
         logger.error(f"Error in chat endpoint: {str(e)}", exc_info=True)
-        return jsonify({'error': 'Internal server error', 'details': str(e)}), 500
\ No newline at end of file
+        return jsonify({'error': 'Internal server error', 'details': str(e)}), 500
+
+@bot.route('/jobs/rank', methods=['POST'])
+def create_rank_job():
+    try:
+        auth_header = request.headers.get('Authorization')
+        if not auth_header:
+            return jsonify({'error': 'No authorization token'}), 401
+
+        user_id, user_role = get_user_from_token(auth_header)
+        if not user_id or not user_role:
+            return jsonify({'error': 'Invalid token'}), 401
+        if user_role != 'company':
+            return jsonify({'error': 'Only companies can rank students'}), 403
+
+        data = request.get_json(silent=True) or {}
+        internship_ids = data.get('internshipIds')
+        if internship_ids is not None and not isinstance(internship_ids, list):
+            return jsonify({'error': 'internshipIds must be a list'}), 400
+
+        job_id = ranking_jobs.submit(user_id, internship_ids)
+        return jsonify({'jobId': job_id, 'status': 'queued'}), 202
+    except (InvalidId, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error creating ranking job: {str(e)}", exc_info=True)
+        return jsonify({'error': 'Internal server error'}), 500
+
+@bot.route('/jobs/<job_id>', methods=['GET'])
+def get_rank_job(job_id):
+    try:
+        auth_header = request.headers.get('Authorization')
+        if not auth_header:
+            return jsonify({'error': 'No authorization token'}), 401
+
+        user_id, user_role = get_user_from_token(auth_header)
+        if not user_id or not user_role:
+            return jsonify({'error': 'Invalid token'}), 401
+
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = min(max(request.args.get('per_page', 50, type=int), 1), 500)
+        job = ranking_jobs.get(job_id, user_id, request.args.get('internshipId'), page, per_page)
+        if not job:
+            return jsonify({'error': 'Job not found'}), 404
+        return jsonify(job)
+    except InvalidId:
+        return jsonify({'error': 'Invalid id'}), 400
+    except Exception as e:
+        logger.error(f"Error fetching ranking job: {str(e)}", exc_info=True)
+        return jsonify({'error': 'Internal server error'}), 500
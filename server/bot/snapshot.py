@@ -0,0 +1,161 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import threading
+from datetime import datetime
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CURRENT_FILE = "CURRENT"
+VECTORS_FILE = "vectors.npy"
+META_FILE = "meta.json"
+
+
+def _timestamp(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _fsync_path(path):
+    """Flush a file or directory entry to disk"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def export_snapshot(db, directory, dtype="float32", keep=2):
+    """Write all cached student embeddings as a contiguous array plus an id sidecar.
+
+    The snapshot goes into a fresh subdirectory which, with both files, is
+    fsynced before it is published by atomically replacing the CURRENT
+    pointer, so readers never observe a partial export, even after a crash.
+    Returns the snapshot name.
+    """
+    os.makedirs(directory, exist_ok=True)
+    docs = list(db.studentembeddings.find({}, {"vector": 1, "updatedAt": 1}))
+    dimension = len(docs[0]["vector"]) if docs else 0
+
+    name = "snapshot-" + datetime.now().strftime("%Y%m%d%H%M%S%f")
+    path = os.path.join(directory, name)
+    os.makedirs(path)
+
+    vectors = np.lib.format.open_memmap(
+        os.path.join(path, VECTORS_FILE), mode="w+", dtype=dtype, shape=(len(docs), dimension)
+    )
+    for row, doc in enumerate(docs):
+        vectors[row] = doc["vector"]
+    vectors.flush()
+    del vectors
+
+    with open(os.path.join(path, META_FILE), "w", encoding="utf-8") as f:
+        json.dump({
+            "dtype": dtype,
+            "dimension": dimension,
+            "createdAt": datetime.now().isoformat(),
+            "ids": [str(doc["_id"]) for doc in docs],
+            "updatedAt": [_timestamp(doc.get("updatedAt")) for doc in docs]
+        }, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    # Make the array and the new directory entries durable before publishing
+    _fsync_path(os.path.join(path, VECTORS_FILE))
+    _fsync_path(path)
+    _fsync_path(directory)
+
+    pointer = os.path.join(directory, CURRENT_FILE)
+    with open(pointer + ".tmp", "w", encoding="utf-8") as f:
+        f.write(name)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(pointer + ".tmp", pointer)
+    _fsync_path(directory)
+    logger.info(f"Exported {len(docs)} embeddings to {path}")
+
+    # Readers that still map an older snapshot keep their pages after unlink
+    snapshots = sorted(d for d in os.listdir(directory) if d.startswith("snapshot-"))
+    for old in snapshots[:-keep]:
+        shutil.rmtree(os.path.join(directory, old), ignore_errors=True)
+    return name
+
+
+class _Snapshot:
+    def __init__(self, path):
+        self.vectors = np.load(os.path.join(path, VECTORS_FILE), mmap_mode="r")
+        with open(os.path.join(path, META_FILE), encoding="utf-8") as f:
+            meta = json.load(f)
+        self.rows = {student_id: row for row, student_id in enumerate(meta["ids"])}
+        self.updated_at = meta["updatedAt"]
+
+
+class EmbeddingSnapshot:
+    """Read-only, memory-mapped view of the latest exported embedding snapshot.
+
+    Vectors are mapped with `mmap_mode='r'` so every worker on the host shares
+    the same page-cache pages. `refresh()` is a cheap check of the CURRENT
+    pointer and swaps in a newer snapshot when an export has published one.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._name = None
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        try:
+            with open(os.path.join(self.directory, CURRENT_FILE), encoding="utf-8") as f:
+                name = f.read().strip()
+        except FileNotFoundError:
+            return False
+        if name == self._name:
+            return False
+
+        with self._lock:
+            if name == self._name:
+                return False
+            try:
+                snapshot = _Snapshot(os.path.join(self.directory, name))
+            except Exception as e:
+                logger.error(f"Error loading embedding snapshot {name}: {str(e)}", exc_info=True)
+                return False
+            # Single reference assignment; readers holding the old one finish with it
+            self._snapshot, self._name = snapshot, name
+        logger.info(f"Loaded embedding snapshot {name} with {len(snapshot.rows)} vectors")
+        return True
+
+    def lookup(self, student_id, updated_at=None):
+        """Return the vector for a student, or None if missing or older than updated_at"""
+        snapshot = self._snapshot
+        if snapshot is None:
+            return None
+        row = snapshot.rows.get(str(student_id))
+        if row is None:
+            return None
+        if updated_at is not None and snapshot.updated_at[row] != _timestamp(updated_at):
+            return None
+        return snapshot.vectors[row]
+
+
+# Run as `python bot/snapshot.py --dir <path>` after an ingestion run; importing
+# the bot package would start the whole assistant
+if __name__ == "__main__":
+    from pymongo import MongoClient
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Export cached student embeddings to an mmap-able snapshot")
+    parser.add_argument("--dir", default=os.getenv("BOT_EMBEDDING_SNAPSHOT_DIR"), required=not os.getenv("BOT_EMBEDDING_SNAPSHOT_DIR"))
+    parser.add_argument("--dtype", choices=["float32", "float16"], default="float32")
+    parser.add_argument("--keep", type=int, default=2, help="number of snapshots to keep on disk")
+    args = parser.parse_args()
+
+    db = MongoClient(os.getenv("MONGO_URI")).khmayes
+    export_snapshot(db, args.dir, args.dtype, args.keep)
@@ -0,0 +1,98 @@
+import hashlib
+import logging
+from typing import List
+from .retrieval import cv_summary
+
+logger = logging.getLogger(__name__)
+
+
+def _isoformat(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else (value or '')
+
+
+def catalogue_version(internships: List[dict], students: List[dict] = ()) -> str:
+    """Cheap version of a catalogue from ids and last-modified times, without serialising it"""
+    internship_times = [t for i in internships for t in (i.get('updatedAt'), i.get('companyUpdatedAt')) if t]
+    student_times = [s['updatedAt'] for s in students if s.get('updatedAt')]
+    parts = (
+        sorted(str(i.get('_id')) for i in internships),
+        str(max(internship_times, default='')),
+        len(students),
+        str(max(student_times, default=''))
+    )
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def student_context(student: dict, cv_text: str, internships: List[dict]) -> dict:
+    """Prompt context for a student, without retrieval results or conversation"""
+    # Format internships for context with complete details
+    all_internships = []
+    for internship in internships:
+        all_internships.append({
+            "title": internship.get('title', ''),
+            "company": internship.get('company', ''),
+            "description": internship.get('description', ''),
+            "type": internship.get('type', ''),
+            "technologies": internship.get('technologies', []),
+            "salary": internship.get('salary', ''),
+            "duration": internship.get('duration', '')
+        })
+
+    return {
+        "student_profile": {
+            "name": student.get('name', ''),
+            "university": student.get('university', ''),
+            "degree": student.get('degree', ''),
+            "year": student.get('year', '')
+        },
+        "cv_content": cv_text[:500] + "..." if cv_text else "No CV uploaded",
+        "all_internships": all_internships,
+        "catalogue_version": catalogue_version(internships)
+    }
+
+
+def company_context(students: List[dict], cv_texts: List[str], company_internships: List[dict]) -> dict:
+    """Prompt context for a company, without retrieval results or conversation"""
+    # Collect complete student profiles with CV content
+    complete_student_profiles = []
+    for student, cv_text in zip(students, cv_texts):
+        complete_student_profiles.append({
+            "name": student.get('name', ''),
+            "email": student.get('email', ''),
+            "university": student.get('university', ''),
+            "degree": student.get('degree', ''),
+            "year": student.get('year', ''),
+            "resumeUrl": student.get('resumeUrl', ''),
+            # Limit CV content size to prevent token overflow
+            "cv_content": cv_summary(student, cv_text),
+            "createdAt": _isoformat(student.get('createdAt')),
+            "updatedAt": _isoformat(student.get('updatedAt'))
+        })
+
+    # Format company internships with complete details
+    formatted_company_internships = []
+    for internship in company_internships:
+        formatted_company_internships.append({
+            "title": internship.get('title', ''),
+            "company": internship.get('company', ''),
+            "description": internship.get('description', ''),
+            "type": internship.get('type', ''),
+            "technologies": internship.get('technologies', []),
+            "salary": internship.get('salary', ''),
+            "duration": internship.get('duration', ''),
+            "numberOfInterns": internship.get('numberOfInterns', ''),
+            "createdAt": _isoformat(internship.get('createdAt')),
+            "updatedAt": _isoformat(internship.get('updatedAt'))
+        })
+
+    return {
+        "company_internships": formatted_company_internships,
+        "all_students": complete_student_profiles,
+        "students_summary": {
+            "total_students": len(complete_student_profiles),
+            "students_with_cv": len([s for s in complete_student_profiles if s['cv_content'] not in ["No CV uploaded", "No CV content available"]]),
+            "universities": sorted(set([s['university'] for s in complete_student_profiles if s['university']])),
+            "degrees": sorted(set([s['degree'] for s in complete_student_profiles if s['degree']]))
+        },
+        "catalogue_version": catalogue_version(company_internships, students)
+    }
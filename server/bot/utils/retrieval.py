@@ -0,0 +1,156 @@
+import uuid
+import logging
+from typing import List, Tuple
+from langchain_community.vectorstores import Chroma
+from .pdf_parser import chunk_text
+
+logger = logging.getLogger(__name__)
+
+STUDENT_QUERY = "internship requirements and skills"
+COMPANY_QUERY = "student qualifications skills experience internship matching"
+
+DEFAULT_CHUNK_SIZE = 1000
+DEFAULT_OVERLAP = 100
+DEFAULT_STUDENT_K = 5
+DEFAULT_COMPANY_K = 10
+
+
+def cv_summary(student: dict, cv_text: str) -> str:
+    """CV excerpt shown in a company's view of a student"""
+    if not student.get('resumeUrl'):
+        return "No CV uploaded"
+    if not cv_text:
+        return "No CV content available"
+    return cv_text[:2000] + "..." if len(cv_text) > 2000 else cv_text
+
+
+def build_student_corpus(student: dict, cv_text: str, internships: List[dict],
+                         chunk_size: int = DEFAULT_CHUNK_SIZE,
+                         overlap: int = DEFAULT_OVERLAP) -> Tuple[List[str], List[dict]]:
+    """Texts and metadatas searched for a student: CV chunks, profile and all internships"""
+    texts = []
+    metadatas = []
+
+    if cv_text:
+        cv_chunks = chunk_text(cv_text, chunk_size, overlap)
+        texts.extend(cv_chunks)
+        metadatas.extend([{
+            "source": "cv",
+            "chunk_type": "cv_content"
+        } for _ in cv_chunks])
+        logger.info(f"Added {len(cv_chunks)} CV chunks to vector store")
+
+    # Add profile data as additional context
+    profile_text = f"""
+            Student Profile:
+            Name: {student.get('name', '')}
+            University: {student.get('university', '')}
+            Degree: {student.get('degree', '')}
+            Year: {student.get('year', '')}
+            """
+    texts.append(profile_text)
+    metadatas.append({
+        "source": "profile",
+        "chunk_type": "student_info"
+    })
+
+    # Format internships with complete information
+    for internship in internships:
+        internship_text = f"""
+                Title: {internship.get('title', '')}
+                Company: {internship.get('company', '')}
+                Description: {internship.get('description', '')}
+                Type: {internship.get('type', '')}
+                Technologies: {', '.join(internship.get('technologies', []))}
+                Salary: {internship.get('salary', '')}
+                Duration: {internship.get('duration', '')}
+                """
+        texts.append(internship_text)
+        metadatas.append({
+            "source": "internship",
+            "company": internship.get('company', ''),
+            "title": internship.get('title', ''),
+            "type": internship.get('type', ''),
+            "internship_id": str(internship.get('_id', ''))
+        })
+
+    return texts, metadatas
+
+
+def build_company_corpus(students: List[dict], cv_texts: List[str], internships: List[dict],
+                         chunk_size: int = DEFAULT_CHUNK_SIZE,
+                         overlap: int = DEFAULT_OVERLAP) -> Tuple[List[str], List[dict]]:
+    """Texts and metadatas searched for a company: every student's CV and profile plus its internships"""
+    texts = []
+    metadatas = []
+
+    for student, cv_text in zip(students, cv_texts):
+        student_metadata = {
+            "student_name": student.get('name', ''),
+            "student_degree": student.get('degree', ''),
+            "student_university": student.get('university', ''),
+            "student_email": student.get('email', ''),
+            "student_year": student.get('year', ''),
+            "student_id": str(student.get('_id', ''))
+        }
+
+        if cv_text:
+            cv_chunks = chunk_text(cv_text, chunk_size, overlap)
+            texts.extend(cv_chunks)
+            metadatas.extend([dict(student_metadata, source="cv") for _ in cv_chunks])
+            logger.info(f"Added {len(cv_chunks)} CV chunks for student {student.get('name')}")
+
+        # Add student profile as searchable text
+        profile_text = f"""
+                Student: {student.get('name', '')}
+                Email: {student.get('email', '')}
+                University: {student.get('university', '')}
+                Degree: {student.get('degree', '')}
+                Year: {student.get('year', '')}
+                Profile Summary: {cv_summary(student, cv_text)[:300]}...
+                """
+        texts.append(profile_text)
+        metadatas.append(dict(student_metadata, source="student_profile"))
+
+    # Format company internships with complete information
+    for internship in internships:
+        internship_text = f"""
+                Company Internship:
+                Title: {internship.get('title', '')}
+                Company: {internship.get('company', '')}
+                Description: {internship.get('description', '')}
+                Type: {internship.get('type', '')}
+                Technologies: {', '.join(internship.get('technologies', []))}
+                Salary: {internship.get('salary', '')}
+                Duration: {internship.get('duration', '')}
+                Number of Interns: {internship.get('numberOfInterns', '')}
+                """
+        texts.append(internship_text)
+        metadatas.append({
+            "source": "company_internship",
+            "company": internship.get('company', ''),
+            "title": internship.get('title', ''),
+            "internship_id": str(internship.get('_id', ''))
+        })
+
+    return texts, metadatas
+
+
+def build_index(embeddings, texts: List[str], metadatas: List[dict], space: str = None):
+    """Embed texts into a fresh, isolated Chroma collection"""
+    logger.info(f"Creating vector store with {len(texts)} texts")
+    return Chroma.from_texts(
+        texts=texts,
+        embedding=embeddings,
+        metadatas=metadatas,
+        # Unique name so concurrent requests never share the in-process default collection
+        collection_name=f"context-{uuid.uuid4().hex}",
+        collection_metadata={"hnsw:space": space} if space else None
+    )
+
+
+def search(vectorstore, query: str, k: int):
+    try:
+        return vectorstore.similarity_search(query, k=k)
+    finally:
+        vectorstore.delete_collection()